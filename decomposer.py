@@ -2,11 +2,13 @@
 # -*- coding: utf-8 -*-
 import logging
 import sys
-from functools import partial
 
 import librosa
 import numpy as np
-from scipy.signal import find_peaks
+import soundfile as sf
+from scipy.fft import rfft
+from scipy.ndimage import median_filter, minimum_filter1d
+from scipy.signal import get_window, resample_poly
 from tqdm import tqdm
 
 from signal_process_utils import generate_frequency_table, get_memory_usage
@@ -39,17 +41,24 @@ class Decomposer(object):
         self.norm_algo = 'div_max'  # algorithm to normalize spectral vectors
         self.amp_thresh = 0.3       # float [0, 1] threshold normalized amplitudes must exceed to be mapped to piano
 
-        # raw audio/acoustic data
-        self.audio_ts, self.sample_rate = librosa.load(wav_file, sr=self.max_freq * 2, duration=self.stop_time)
+        # raw audio/acoustic data: read at the native rate, then resample once with
+        # scipy's polyphase filter, which is much lighter than librosa.load's resampler
+        audio_ts, native_rate = sf.read(wav_file, dtype='float32')
+        if audio_ts.ndim > 1:
+            audio_ts = audio_ts.mean(axis=1)  # downmix to mono
+        if self.stop_time:
+            audio_ts = audio_ts[:int(self.stop_time * native_rate)]
+        self.sample_rate = self.max_freq * 2
+        if native_rate != self.sample_rate:
+            audio_ts = resample_poly(audio_ts, self.sample_rate, native_rate)
+        self.audio_ts = audio_ts.astype(np.float32, copy=False)
         self.duration = librosa.get_duration(self.audio_ts, sr=self.sample_rate)
         self.freq_table = generate_frequency_table()
 
-        def _find_nearest(value, array):
-            """ Quantize a value (detected frequency) to piano's nearest fundemental frequency."""
-            idx = np.argmin(np.abs(array - value))
-            return self.last_key_num - idx
-
-        self._map_freq2note = np.vectorize(partial(_find_nearest, array=self.freq_table['Frequency (Hz)'].values))
+        # frequency table sorted ascending for searchsorted, plus the permutation back to table order
+        freqs = self.freq_table['Frequency (Hz)'].values
+        self._freq_order = np.argsort(freqs)
+        self._freq_sorted = freqs[self._freq_order]
 
     def cvt_audio_to_piano(self):
         """ Apply the audio file to visual piano representation pipeline. """
@@ -62,6 +71,24 @@ class Decomposer(object):
         self._parse_spectrogram()
         logger.info(f'[DECOMPOSER] >>>> _parse_spectrogram. MEM: {get_memory_usage()}')
 
+    def _map_freq2note(self, values):
+        """ Quantize detected frequencies to the piano's nearest fundemental frequencies.
+
+        Args:
+            values (np.ndarray): detected frequencies (Hz)
+
+        Returns:
+            np.ndarray: corresponding piano key numbers
+        """
+        idx = np.searchsorted(self._freq_sorted, values)
+        idx = np.clip(idx, 1, len(self._freq_sorted) - 1)
+
+        # step back one slot wherever the left neighbour is closer
+        left = self._freq_sorted[idx - 1]
+        right = self._freq_sorted[idx]
+        idx -= (values - left) < (right - values)
+        return self.last_key_num - self._freq_order[idx]
+
     @staticmethod
     def _normalize_filter(matrix, axis=0, algo='div_max'):
         """ Normalize matrix along a given axis.
@@ -73,45 +100,56 @@ class Decomposer(object):
                 div_max: divide all values by max in vector:x/max(x)
                 zero_one: scale vector between [0-1]: (x - min(x)) / (max(x) - min(x))
         """
-        norm_algo = {
-            'div_max': lambda x: x / max(x),
-            'zero_one': lambda x: (x - min(x)) / (max(x) - min(x))
-        }
-        normalized = np.apply_along_axis(
-            norm_algo[algo],
-            axis=axis,
-            arr=matrix
-        )
-        normalized[np.isnan(normalized)] = 0
-        return normalized
-
-    @staticmethod
-    def _median_filter(arr, length=5, stride=1):
-        """ Compute the 1D median filter of an array. This helps remove outliers and noise.
+        if algo == 'div_max':
+            hi = matrix.max(axis=axis, keepdims=True)
+            return matrix / np.where(hi > 0, hi, 1)
+        if algo == 'zero_one':
+            lo = matrix.min(axis=axis, keepdims=True)
+            rng = matrix.max(axis=axis, keepdims=True) - lo
+            return np.where(rng > 0, (matrix - lo) / np.where(rng > 0, rng, 1), 0)
+        raise ValueError(f'Unknown normalization algo: {algo}')
+
+    def _stft_magnitude_tiled(self, tile_frames=512):
+        """ Compute the STFT magnitude spectrogram in tiles along the time axis.
+
+        Equivalent to taking the magnitude of one full librosa.stft call, but only
+        one tile's worth of complex STFT columns is ever resident, which caps peak
+        memory on long songs.
 
         Args:
-            arr (np.ndarray): arr to filter
-            length (int): window size
-            stride (int): step size
+            tile_frames (int): number of STFT frames to compute per tile
 
         Returns:
-            smoothed np.ndarray
+            np.ndarray: float32 magnitude spectrogram, shape (1 + n_fft // 2, num frames)
         """
-        nrows = ((arr.size - length) // stride) + 1
-        n = arr.strides[0]
-        windowed_matrix = np.lib.stride_tricks.as_strided(arr, shape=(nrows, length), strides=(stride * n, n))
-        median = np.median(windowed_matrix, axis=1)
-        arr[-median.shape[0] :] = median
-        return arr
+        hop_length = self.n_fft // 4
+        window = get_window('hann', self.n_fft, fftbins=True).astype(np.float32)[:, None]
+        padded = np.pad(self.audio_ts, self.n_fft // 2, mode='reflect')
+        num_frames = 1 + (padded.shape[0] - self.n_fft) // hop_length
+
+        tiles = []
+        for start in range(0, num_frames, tile_frames):
+            stop = min(start + tile_frames, num_frames)
+            segment = padded[start * hop_length: (stop - 1) * hop_length + self.n_fft]
+
+            # window all of the tile's frames through a strided view, then run one
+            # batched multithreaded FFT over them
+            stride = segment.strides[0]
+            frames = np.lib.stride_tricks.as_strided(
+                segment, shape=(self.n_fft, stop - start), strides=(stride, hop_length * stride)
+            )
+            stft_tile = rfft(frames * window, axis=0, workers=-1)
+            tiles.append(np.abs(stft_tile).astype(np.float32, copy=False))
+        return np.concatenate(tiles, axis=1)
 
     def _generate_spectrogram(self):
         """ Generate & filter spectrogram, generate corresponding time and frequency alignment vectors.
-        Spectrogram generated by librosa's STFT using {self.n_fft} FFT window size, custom median
-        filter is applied along the time axis.
+        Spectrogram generated by librosa's STFT using {self.n_fft} FFT window size, computed in
+        memory-capped tiles, custom median filter is applied along the time axis.
         Performs Harmonic-Percussive Source Separation (HPSS) on this filtered STFT.
         Performs Vocal Separation on this HPSS filtered STFT. """
 
-        self.spec_raw, phase = librosa.magphase(librosa.stft(self.audio_ts, self.n_fft))
+        self.spec_raw = self._stft_magnitude_tiled()
         self.times = np.linspace(0, self.duration, self.spec_raw.shape[1])
         self.freqs = librosa.fft_frequencies(sr=self.sample_rate, n_fft=self.n_fft)
 
@@ -123,7 +161,7 @@ class Decomposer(object):
             self.t_final = self.times.shape[0]
 
         # median filter along time axis to get rid of white noise
-        self.spec_raw = np.apply_along_axis(self._median_filter, 1, self.spec_raw)
+        self.spec_raw = median_filter(self.spec_raw, size=(1, 5), mode='nearest')
 
         # apply additonal spectrogram maniplation
         self.spec_harmonic, self.spec_percussive = librosa.decompose.hpss(self.spec_raw, margin=2)
@@ -131,8 +169,64 @@ class Decomposer(object):
 
         logger.info('[DECOMPOSER] >>>> Perfomed HPSS and Vocal Separation.')
 
+    @staticmethod
+    def _nn_filter_banded(spectrogram, width, n_neighbors=10, block=512, band=None):
+        """ Banded nearest-neighbor filter over the time axis of a spectrogram.
+
+        Approximates librosa.decompose.nn_filter(aggregate=np.median, metric='cosine')
+        with REPET-SIM semantics: each frame is replaced by the median of its most
+        similar frames that are at least {width} frames away in time, so sustained
+        local content cannot match itself and only true repetitions survive. Instead
+        of the full O(frames^2) pairwise cosine affinity, candidates are limited to a
+        window of +/- {band} frames around each query, which keeps the cost at
+        O(frames x band) while still reaching repeats well beyond the forbidden zone.
+
+        Args:
+            spectrogram (np.ndarray): (freq x time) spectrogram to filter
+            width (int): frames closer than this to the query are excluded as matches
+            n_neighbors (int): number of similar frames to aggregate per frame
+            block (int): number of frames to query per batch
+            band (int): half-width of the candidate search window, in frames.
+                Default: 16 * width.
+
+        Returns:
+            np.ndarray: filtered spectrogram, same shape as input
+        """
+        from sklearn.metrics import pairwise_distances
+
+        if band is None:
+            band = 16 * width
+
+        num_frames = spectrogram.shape[1]
+        norms = np.linalg.norm(spectrogram, axis=0, keepdims=True)
+        unit_frames = (spectrogram / np.where(norms > 0, norms, 1)).astype(np.float32).T
+
+        filtered = np.empty_like(spectrogram)
+        for start in range(0, num_frames, block):
+            stop = min(start + block, num_frames)
+            lo = max(0, start - band)
+            hi = min(num_frames, stop + band)
+
+            distances = pairwise_distances(unit_frames[start:stop], unit_frames[lo:hi], metric='cosine')
+
+            # forbid the locally-continuous neighbourhood |query - candidate| < width
+            query_idx = np.arange(start, stop)[:, None]
+            candidate_idx = np.arange(lo, hi)[None, :]
+            distances[np.abs(query_idx - candidate_idx) < width] = np.inf
+
+            k = min(n_neighbors, distances.shape[1])
+            nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+
+            # where a query ran out of allowed candidates, fall back to its own column
+            exhausted = np.take_along_axis(distances, nearest, axis=1) == np.inf
+            matched_cols = np.where(exhausted, query_idx, lo + nearest)
+
+            matched = spectrogram[:, matched_cols]  # (freq x block x k)
+            filtered[:, start:stop] = np.median(matched, axis=2)
+        return filtered
+
     def _spectrogram_separate_vocals(self, spectrogram):
-        """ Use Librosa's nearest-neighbor-filtering to separate voice from background of spectrogram.
+        """ Use banded nearest-neighbor-filtering to separate voice from background of spectrogram.
 
         Args:
             spectrogram (np.ndarray): spectrogram to process.
@@ -142,10 +236,8 @@ class Decomposer(object):
             np.ndarray: spectrogram of background (harmonics)
 
         """
-        s_filter = librosa.decompose.nn_filter(
+        s_filter = self._nn_filter_banded(
             spectrogram,
-            aggregate=np.median,
-            metric='cosine',
             width=int(librosa.time_to_frames(2, sr=self.sample_rate))
         )
 
@@ -185,29 +277,31 @@ class Decomposer(object):
         """ Parse the spectrogram by iterating through the time axis, thresholding
         away quiet frequencies, and mapping the dominant frequencies to piano keys."""
 
-        def _get_peaks_and_threshold(t):
-            """ Given a time(t), extract the dominant frequencies in the amplitude
-            matrix using argrelextrema, and threshold all other values to zero.
-            Store in a new matrix, self.dominant_amplitudes. Thresholding performed by
-            selecting the inverse indices of the detected peaks. Populates class
-            property matrcies.
-
-            Args:
-                t (int): time point to extract note data
-
+        def _get_peaks_and_threshold():
+            """ Extract the dominant frequencies in the amplitude matrix and threshold
+            all other values to zero. Store in a new matrix, self.dominant_amplitudes.
+            Peaks are detected on all time frames at once: a frequency bin is dominant
+            if it is a local maximum along the frequency axis and rises at least 3 log
+            units above the surrounding valley floor (a vectorized stand-in for
+            find_peaks' prominence=3). Populates class property matrcies.
             """
 
-            # peak detection in a amplitude vector at time t
-            # take log of vec since amplitudes decay exponentially at higher freqs
+            # peak detection on the log amplitudes, since amplitudes decay exponentially at higher freqs
             # https://stackoverflow.com/questions/1713335/peak-finding-algorithm-for-python-scipy/52612432#52612432
-            peaks_idx = find_peaks(np.log(self.amplitudes[:, t]), prominence=3)[0]
+            log_amps = np.log(np.maximum(self.amplitudes, 1e-12))
+
+            # local maxima along the frequency axis
+            is_peak = np.zeros_like(log_amps, dtype=bool)
+            is_peak[1:-1] = (log_amps[1:-1] > log_amps[:-2]) & (log_amps[1:-1] > log_amps[2:])
 
-            # select inverse indices of peaks, threshold to zero
-            arr = self.dominant_amplitudes[:, t]
-            ia = np.indices(arr.shape)
-            not_indices = np.setxor1d(ia, peaks_idx)
-            arr[not_indices] = 0
-            self.dominant_amplitudes[:, t] = arr
+            # approximate prominence with the higher of the valley floors on either side of each bin
+            window = 64
+            left_valley = minimum_filter1d(log_amps, size=window, axis=0, mode='nearest', origin=window // 2 - 1)
+            right_valley = minimum_filter1d(log_amps, size=window, axis=0, mode='nearest', origin=-(window // 2))
+            is_peak &= (log_amps - np.maximum(left_valley, right_valley)) > 3
+
+            # keep peak bins, zero everything else, without copying the full spectrum first
+            self.dominant_amplitudes = np.where(is_peak, self.amplitudes, 0)
 
         def _extract_notes_and_populate_chromagram(t):
             """ Map the dominant frequencies at time(t) to the corresponding piano keys.
@@ -238,17 +332,15 @@ class Decomposer(object):
                 return key_number_array, amp_array_non_zero
             return None, None
 
-        # init dom freqs matrix, iterate through time, find peaks and threshold
-        self.dominant_amplitudes = self.amplitudes.copy()
-        for time in tqdm(range(self.t_final)):
-            _get_peaks_and_threshold(time)
+        # init dom freqs matrix, find peaks across all time frames and threshold
+        _get_peaks_and_threshold()
         logger.info(f'[DECOMPOSER] >>>> Parsed spectrogram. Found dominant frequencies. MEM {get_memory_usage()}')
 
         # median filter along time axis to get rid of white noise
-        self.dominant_amplitudes = np.apply_along_axis(self._median_filter, 1, self.dominant_amplitudes)
+        self.dominant_amplitudes = median_filter(self.dominant_amplitudes, size=(1, 5), mode='nearest')
 
         # iterate through time, map dominant frequencies to notes
-        self.chromagram_raw = np.zeros((self.last_key_num, self.t_final))
+        self.chromagram_raw = np.zeros((self.last_key_num, self.t_final), dtype=np.float32)
         for time in tqdm(range(self.t_final)):
             _extract_notes_and_populate_chromagram(time)
         self.chromagram = self._normalize_and_threshold_chromagram()